@@ -1,7 +1,10 @@
 #!/usr/bin/python3
 
 import collections
-import glob
+import contextlib
+import enum
+import fcntl
+import functools
 import hashlib
 from json import JSONEncoder
 import json
@@ -10,7 +13,27 @@ import os
 import re
 import subprocess
 import sys
-from typing import Optional, Tuple, Dict, Type, Any, List
+import threading
+import time
+from typing import (
+    Optional,
+    Tuple,
+    Dict,
+    FrozenSet,
+    Set,
+    Type,
+    Any,
+    List,
+    ItemsView,
+    Iterator,
+    Union,
+    ValuesView,
+)
+
+try:
+    import orjson  # type: ignore[import-not-found, unused-ignore]
+except ImportError:
+    orjson = None  # type: ignore[assignment, unused-ignore]
 
 
 PATH_MAX = 4096
@@ -50,55 +73,60 @@ def valid_path(folder: str) -> bool:
     return len(folder) < PATH_MAX and os.path.abspath(folder) == folder
 
 
-class Response(object):
-    def __init__(self, name: str) -> None:
-        self.name = name
+# Properties of a response, combined into the value of each Response.
+_ALLOW = 0x1
+_DENY = 0x2
+_ONETIME = 0x4
+_ALWAYS = 0x8
+_BLOCK = 0x10
+
+
+class Response(enum.Enum):
+    ALLOW_ONETIME = _ALLOW | _ONETIME
+    DENY_ONETIME = _DENY | _ONETIME
+    ALLOW_ALWAYS = _ALLOW | _ALWAYS
+    DENY_ALWAYS = _DENY | _ALWAYS
+    BLOCK = _BLOCK
 
     def __str__(self) -> str:
         return self.name
 
-    def __repr__(self) -> str:
-        return "<Response " + self.name + " %s>" % id(self)
-
     def is_allow(self) -> bool:
-        return self.name.startswith("ALLOW")
+        return bool(self.value & _ALLOW)
 
     def is_onetime(self) -> bool:
-        return self.name.endswith("ONETIME")
+        return bool(self.value & _ONETIME)
 
     def is_block(self) -> bool:
-        return self.name == "BLOCK"
+        return self is Response.BLOCK
 
     @staticmethod
     def from_string(string):  # type: (str) -> Response
-        global RESPONSES
         try:
-            r = RESPONSES.__dict__[string]
-            assert isinstance(r, Response)
-            return r
+            return Response[string]
         except KeyError:
             raise ValueError(string)
 
 
-class RESPONSES(object):
-    ALLOW_ONETIME = Response("ALLOW_ONETIME")
-    DENY_ONETIME = Response("DENY_ONETIME")
-    ALLOW_ALWAYS = Response("ALLOW_ALWAYS")
-    DENY_ALWAYS = Response("DENY_ALWAYS")
-    BLOCK = Response("BLOCK")
+RESPONSES = Response
 
 
 logger = logging.getLogger(__name__)
 
 
-def contains(needle: str, haystack: str) -> bool:
-    """Check if the needle path is contained in the haystack path."""
-    needle = os.path.abspath(needle)
-    haystack = os.path.abspath(haystack)
-    if not needle.endswith(os.path.sep):
-        needle = needle + os.path.sep
-    if not haystack.endswith(os.path.sep):
-        haystack = haystack + os.path.sep
+@functools.lru_cache(maxsize=4096)
+def _norm(path: str) -> str:
+    # Absolute paths without empty, "." or ".." components are already
+    # in the form abspath() would return, save for a trailing separator.
+    if not (path.startswith("/") and "//" not in path and "/." not in path):
+        path = os.path.abspath(path)
+    if not path.endswith(os.path.sep):
+        path = path + os.path.sep
+    return path
+
+
+@functools.lru_cache(maxsize=4096)
+def _contains_norm(needle: str, haystack: str) -> bool:
     if needle == haystack:
         return True
     if (needle).startswith(haystack):
@@ -106,22 +134,36 @@ def contains(needle: str, haystack: str) -> bool:
     return False
 
 
+def contains(needle: str, haystack: str) -> bool:
+    """Check if the needle path is contained in the haystack path."""
+    return _contains_norm(_norm(needle), _norm(haystack))
+
+
+# UTF-8 forms of the qube names and folders being fingerprinted.
+_utf8_cache: Dict[str, bytes] = {}
+
+
+def _u8(s: str) -> bytes:
+    b = _utf8_cache.get(s)
+    if b is None:
+        if len(_utf8_cache) >= 4096:
+            _utf8_cache.clear()
+        b = _utf8_cache[s] = s.encode("utf-8")
+    return b
+
+
 def fingerprint_decision(source: str, target: str, folder: str) -> str:
-    fingerprint = hashlib.sha256()
-    fingerprint.update(source.encode("utf-8"))
-    fingerprint.update(b"\0")
-    fingerprint.update(target.encode("utf-8"))
-    fingerprint.update(b"\0")
-    fingerprint.update(folder.encode("utf-8"))
-    fingerprint.update(b"\0")
-    return fingerprint.hexdigest()[:32]
+    return _fp(source, target, folder)
+
+
+@functools.lru_cache(maxsize=2048)
+def _fp(source: str, target: str, folder: str) -> str:
+    buf = b"\0".join((_u8(source), _u8(target), _u8(folder), b""))
+    return hashlib.sha256(buf).digest()[:16].hex()
 
 
 class Decision(object):
-    source = ""
-    target = ""
-    folder = ""
-    response = Response("invalid")
+    __slots__ = ("source", "target", "folder", "folder_with_sep", "response")
 
     def __init__(
         self, source: str, target: str, folder: str, response: Response
@@ -129,6 +171,7 @@ class Decision(object):
         self.source = source
         self.target = target
         self.folder = folder
+        self.folder_with_sep = _norm(folder)
         self.response = response
 
     def __repr__(self) -> str:
@@ -140,31 +183,375 @@ class Decision(object):
         )
 
 
-class DecisionMatrix(Dict[str, Decision]):
+def _encode(obj: Any) -> Any:
+    if isinstance(obj, Decision):
+        return {
+            "source": obj.source,
+            "target": obj.target,
+            "folder": obj.folder,
+            "response": str(obj.response),
+        }
+    if isinstance(obj, Response):
+        return str(obj)
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+
+class _DecisionMatrixEncoder(JSONEncoder):
+    def default(self, obj: Any) -> Any:
+        return _encode(obj)
+
+
+def _decode(obj: Dict[str, str]) -> Decision:
+    return Decision(
+        source=obj["source"],
+        target=obj["target"],
+        folder=obj["folder"],
+        response=Response.from_string(obj["response"]),
+    )
+
+
+def _loads(data: bytes) -> Any:
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def _dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        data: bytes = orjson.dumps(obj, default=_encode)
+        return data
+    return json.dumps(obj, default=_encode).encode("utf-8")
+
+
+class _FolderTrie(object):
+    """Decisions for one (source, target) pair, arranged by folder components.
+
+    Finding every decision whose folder contains a path takes one step per
+    component of the path, regardless of how many decisions are stored."""
+
+    __slots__ = ("children", "decisions")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, _FolderTrie] = {}
+        # Most recently added first.
+        self.decisions: List[Tuple[str, Decision]] = []
+
+    @staticmethod
+    def _components(normalized_path: str) -> List[str]:
+        return [c for c in normalized_path.split(os.path.sep) if c]
+
+    def insert(self, fingerprint: str, decision: Decision) -> None:
+        node = self
+        for c in self._components(decision.folder_with_sep):
+            node = node.children.setdefault(c, _FolderTrie())
+        node.decisions.insert(0, (fingerprint, decision))
+
+    def remove(self, fingerprint: str, decision: Decision) -> None:
+        path = [self]
+        components = self._components(decision.folder_with_sep)
+        for c in components:
+            path.append(path[-1].children[c])
+        path[-1].decisions.remove((fingerprint, decision))
+        for c, parent, node in reversed(list(zip(components, path, path[1:]))):
+            if node.decisions or node.children:
+                break
+            del parent.children[c]
+
+    def is_empty(self) -> bool:
+        return not self.decisions and not self.children
+
+    def containing(self, normalized_path: str) -> List[Tuple[str, Decision]]:
+        """Return the decisions whose folder contains the path, deepest first."""
+        levels = [self.decisions]
+        node = self
+        for c in self._components(normalized_path):
+            child = node.children.get(c)
+            if child is None:
+                break
+            node = child
+            levels.append(node.decisions)
+        return [entry for level in reversed(levels) for entry in level]
+
+
+_FileKey = Optional[Tuple[int, int, int]]
+_DbKey = Tuple[str, _FileKey, _FileKey]
+
+# The last policy database loaded or saved by this process, keyed by the
+# path and identity of the files it came from.
+_cache = None  # type: Optional[Tuple[_DbKey, DecisionMatrix]]
+_cache_lock = threading.Lock()
+
+
+def _file_key(path: str) -> _FileKey:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _json_key(key: _FileKey) -> Optional[List[int]]:
+    """Return key as it reads back from a delta file."""
+    return None if key is None else list(key)
+
+
+def _db_key(path: str) -> _DbKey:
+    return (path, _file_key(path), _file_key(path + ".delta"))
+
+
+@contextlib.contextmanager
+def _flock(path: str, exclusive: bool) -> Iterator[None]:
+    """Hold a lock serializing changes to the database at path.
+
+    Readers take it shared.  Appending to the delta file, and replacing the
+    database and removing the delta file, take it exclusively.
+
+    Readers that cannot open the lock file at all, e.g. because the
+    database directory does not exist, go ahead without it."""
+    try:
+        fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o664)
+    except PermissionError:
+        # Locking works just as well through a read-only descriptor.
+        try:
+            fd = os.open(path + ".lock", os.O_RDONLY)
+        except OSError:
+            if exclusive:
+                raise
+            fd = -1
+    except OSError:
+        if exclusive:
+            raise
+        fd = -1
+    if fd < 0:
+        yield
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _fsync_dir(path: str) -> None:
+    """Flush the directory entry of path to disk."""
+    fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class DecisionMatrix(object):
     POLICY_DB = "/etc/qubes/shared-folders/policy.db"
+    # Incremental changes are appended to POLICY_DB + ".delta" and folded
+    # back into POLICY_DB by load() once this many have accumulated.
+    COMPACT_AFTER = 64
+    # With fast saves, changes are written without fsync().  A crash or
+    # power loss shortly after a save may then lose it, or leave an empty
+    # database behind on file systems that do not order data before
+    # renames.  Only enable it where that is an acceptable trade for less
+    # time spent waiting on the disk during authorization requests.
+    FAST_SAVE = os.environ.get("QUBES_SHARED_FOLDERS_FAST_SAVE") == "1"
+
+    def __init__(
+        self, decisions: Union[Dict[str, Decision], "DecisionMatrix", None] = None
+    ) -> None:
+        self._by_fp: Dict[str, Decision] = {}
+        # Secondary index of decisions by (source, target) qube pair, so that
+        # lookups only visit the decisions relevant to the requesting qubes.
+        self._by_pair: Dict[Tuple[str, str], _FolderTrie] = {}
+        # Whether the two dicts above may be referenced by another matrix,
+        # in which case they are copied before the first mutation.
+        self._shared = False
+        # The _db_key() of the files this matrix was last read from or
+        # written to, and how many changes were made to it since.
+        self._key: Optional[_DbKey] = None
+        self._changes = 0
+        if decisions is not None:
+            for k, v in decisions.items():
+                self.put(k, v)
+
+    def __repr__(self) -> str:
+        return "<DecisionMatrix %r>" % self._by_fp
+
+    def __len__(self) -> int:
+        return len(self._by_fp)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._by_fp)
+
+    def __contains__(self, fingerprint: object) -> bool:
+        return fingerprint in self._by_fp
+
+    def __getitem__(self, fingerprint: str) -> Decision:
+        return self._by_fp[fingerprint]
+
+    def get(self, fingerprint: str) -> Optional[Decision]:
+        return self._by_fp.get(fingerprint)
+
+    def items(self) -> ItemsView[str, Decision]:
+        return self._by_fp.items()
+
+    def values(self) -> ValuesView[Decision]:
+        return self._by_fp.values()
+
+    def put(self, fingerprint: str, decision: Decision) -> None:
+        self._unshare()
+        self._changes += 1
+        old = self._by_fp.get(fingerprint)
+        if old is not None:
+            self._unindex(fingerprint, old)
+        self._by_fp[fingerprint] = decision
+        self._by_pair.setdefault(
+            (decision.source, decision.target), _FolderTrie()
+        ).insert(fingerprint, decision)
+
+    def pop(self, fingerprint: str) -> Decision:
+        self._unshare()
+        self._changes += 1
+        decision = self._by_fp.pop(fingerprint)
+        self._unindex(fingerprint, decision)
+        return decision
+
+    def _share(self, klass):  # type: (Type[DecisionMatrix]) -> DecisionMatrix
+        """Return a matrix of the given class backed by the same storage.
+
+        This is O(1); the O(N) copy is deferred until either matrix is
+        first mutated, which most callers of load() never do."""
+        other = klass()
+        other._by_fp = self._by_fp
+        other._by_pair = self._by_pair
+        other._shared = self._shared = True
+        other._key = self._key
+        return other
+
+    def _unshare(self) -> None:
+        if not self._shared:
+            return
+        decisions, changes = self._by_fp, self._changes
+        self._by_fp = {}
+        self._by_pair = {}
+        self._shared = False
+        for k, v in decisions.items():
+            self.put(k, v)
+        self._changes = changes
+
+    def _unindex(self, fingerprint: str, decision: Decision) -> None:
+        pair = (decision.source, decision.target)
+        trie = self._by_pair[pair]
+        trie.remove(fingerprint, decision)
+        if trie.is_empty():
+            del self._by_pair[pair]
 
     @classmethod
     def load(klass):  # type: (Type[DecisionMatrix]) -> DecisionMatrix
-        def hook(obj: Dict[Any, Any]) -> Any:
-            if "folder" in obj:
-                return Decision(
-                    source=obj["source"],
-                    target=obj["target"],
-                    folder=obj["folder"],
-                    response=Response.from_string(obj["response"]),
-                )
-            else:
-                return DecisionMatrix(obj)
+        with _flock(klass.POLICY_DB, exclusive=False):
+            self, replayed = klass._read(use_cache=True)
+        if replayed >= klass.COMPACT_AFTER:
+            # Start over under an exclusive lock, so that no change can be
+            # appended between replaying the delta file and removing it.
+            try:
+                with _flock(klass.POLICY_DB, exclusive=True):
+                    self, replayed = klass._read(use_cache=False)
+                    if replayed >= klass.COMPACT_AFTER:
+                        self._write()
+            except OSError as e:
+                logger.warning("Cannot compact %s: %s", klass.POLICY_DB, e)
+        return self
 
+    @classmethod
+    def _read(klass, use_cache):
+        # type: (Type[DecisionMatrix], bool) -> Tuple[DecisionMatrix, int]
+        """Read the database and replay its delta file; callers hold the lock.
+
+        Returns the matrix and the number of changes replayed."""
+        key = _db_key(klass.POLICY_DB)
+        with _cache_lock:
+            if use_cache and _cache is not None and _cache[0] == key:
+                # Decisions are never mutated in place, and the storage
+                # is copied before the caller can change it.
+                return _cache[1]._share(klass), 0
+        self = klass()
         try:
-            with open(klass.POLICY_DB, "r") as db:
-                data = json.load(db, object_hook=hook)
-            self = klass()
+            with open(klass.POLICY_DB, "rb") as db:
+                data = _loads(db.read())
             for k, v in data.items():
-                self[k] = v
-            return self
+                self.put(k, _decode(v))
         except Exception:
-            return klass()
+            self = klass()
+        replayed = self._replay_deltas(key[1])
+        # The key was taken before reading; the lock keeps the files from
+        # changing since.
+        self._remember(key)
+        return self, replayed
+
+    def _replay_deltas(self, db: _FileKey) -> int:
+        """Apply the changes recorded by _append_delta() since the last save().
+
+        Only lines appended to the database identified by db apply.  Lines
+        appended to an older database, which a crash kept save() from
+        removing, are already part of it and skipped.
+
+        Returns the number of lines in the delta file."""
+        try:
+            with open(self.POLICY_DB + ".delta", "rb") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return 0
+        for line in lines:
+            try:
+                delta = _loads(line)
+                if "db" in delta and delta["db"] != _json_key(db):
+                    continue
+                if delta["op"] == "set":
+                    self.put(delta["fp"], _decode(delta["decision"]))
+                elif delta["op"] == "del":
+                    if delta["fp"] in self:
+                        self.pop(delta["fp"])
+                else:
+                    raise ValueError(delta["op"])
+            except Exception as e:
+                logger.warning("Skipping bad entry in %s.delta: %s", self.POLICY_DB, e)
+        return len(lines)
+
+    def _append_delta(self, delta: Dict[str, Any]) -> None:
+        """Durably record a single change without rewriting the database."""
+        with _flock(self.POLICY_DB, exclusive=True):
+            before = _db_key(self.POLICY_DB)
+            delta = dict(delta, db=_json_key(before[1]))
+            fd = os.open(
+                self.POLICY_DB + ".delta",
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                0o664,
+            )
+            with open(fd, "ab") as f:
+                created = os.fstat(fd).st_size == 0
+                if created:
+                    os.fchmod(fd, 0o664)
+                f.write(_dumps(delta) + b"\n")
+                f.flush()
+                if not self.FAST_SAVE:
+                    os.fsync(fd)
+            if created and not self.FAST_SAVE:
+                _fsync_dir(self.POLICY_DB)
+            if before == self._key and self._changes == 1:
+                # The files held exactly this matrix minus the change just
+                # recorded, so they now hold exactly this matrix.
+                self._remember(_db_key(self.POLICY_DB))
+            else:
+                self._forget()
+
+    def _remember(self, key: _DbKey) -> None:
+        """Note that the files identified by key hold exactly this matrix."""
+        global _cache
+        self._key = key
+        self._changes = 0
+        with _cache_lock:
+            _cache = (key, self._share(DecisionMatrix))
+
+    def _forget(self) -> None:
+        global _cache
+        self._key = None
+        with _cache_lock:
+            _cache = None
 
     def check_decision(
         self, source: str, target: str, folder: str, response: Optional[Response]
@@ -197,43 +584,83 @@ class DecisionMatrix(Dict[str, Decision]):
             folder = "/"
         fingerprint = fingerprint_decision(source, target, folder)
         decision = Decision(source, target, folder, response)
-        self[fingerprint] = decision
+        self.put(fingerprint, decision)
         return fingerprint
 
     def save(self) -> None:
-        class DecisionMatrixEncoder(JSONEncoder):
-            def default(self, obj: Any) -> Any:
-                if isinstance(obj, Decision):
-                    return obj.__dict__
-                if isinstance(obj, Response):
-                    return str(obj)
-                return JSONEncoder.default(self, obj)
-
-        with open(self.POLICY_DB + ".tmp", "w") as db:
-            json.dump(self, db, indent=4, sort_keys=True, cls=DecisionMatrixEncoder)
-        os.chmod(self.POLICY_DB + ".tmp", 0o664)
-        os.rename(self.POLICY_DB + ".tmp", self.POLICY_DB)
+        with _flock(self.POLICY_DB, exclusive=True):
+            self._write()
+
+    def _write(self) -> None:
+        """Write out the whole database; callers hold the exclusive lock."""
+        has_deltas = os.path.exists(self.POLICY_DB + ".delta")
+        if orjson is not None:
+            data = orjson.dumps(
+                self._by_fp,
+                default=_encode,
+                option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS,
+            )
+        else:
+            data = json.dumps(
+                self._by_fp, indent=4, sort_keys=True, cls=_DecisionMatrixEncoder
+            ).encode("utf-8")
+        try:
+            with open(self.POLICY_DB, "rb") as db:
+                unchanged = db.read() == data
+        except FileNotFoundError:
+            unchanged = False
+        if not unchanged or has_deltas:
+            # Should removing the delta file below not survive a crash, its
+            # lines must not be replayed over the new database, which may
+            # have undone them since.  Replacing the database even when its
+            # contents are unchanged gives it a new identity, which makes the
+            # replay skip them.
+            with open(self.POLICY_DB + ".tmp", "wb") as tmp:
+                tmp.write(data)
+                if not self.FAST_SAVE:
+                    tmp.flush()
+                    os.fsync(tmp.fileno())
+            os.chmod(self.POLICY_DB + ".tmp", 0o664)
+            os.replace(self.POLICY_DB + ".tmp", self.POLICY_DB)
+            if not self.FAST_SAVE:
+                _fsync_dir(self.POLICY_DB)
+        if has_deltas:
+            # Everything recorded in the delta file is now part of the database.
+            try:
+                os.unlink(self.POLICY_DB + ".delta")
+            except FileNotFoundError:
+                pass
+            if not self.FAST_SAVE:
+                _fsync_dir(self.POLICY_DB)
+        self._remember(_db_key(self.POLICY_DB))
 
     def copy(self):  # type: () -> DecisionMatrix
         newd = DecisionMatrix()
         for k, v in self.items():
-            newd[k] = Decision(
-                v.source,
-                v.target,
-                v.folder,
-                v.response,
+            newd.put(
+                k,
+                Decision(
+                    v.source,
+                    v.target,
+                    v.folder,
+                    v.response,
+                ),
             )
         return newd
 
     def revoke_onetime_accesses_for_fingerprint(self, fingerprint: str) -> None:
         """This method mutates the internal state and updates the policy on disk."""
-        if fingerprint in self and self[fingerprint].response.is_onetime():
-            logger.info(
-                "One-time decision expired for %s, applying policy changes", fingerprint
-            )
-            del self[fingerprint]
-            ConnectToFolderPolicy.apply_policy_changes_from(self)
-            self.save()
+        match = self.get(fingerprint)
+        if match is not None and match.response.is_onetime():
+            self._expire(fingerprint)
+
+    def _expire(self, fingerprint: str) -> None:
+        logger.info(
+            "One-time decision expired for %s, applying policy changes", fingerprint
+        )
+        self.pop(fingerprint)
+        ConnectToFolderPolicy.apply_policy_changes_from(self)
+        self._append_delta({"op": "del", "fp": fingerprint})
 
     def lookup_decision(
         self, source: str, target: str, folder: str
@@ -242,21 +669,15 @@ class DecisionMatrix(Dict[str, Decision]):
 
         If no decision is made, prospectively generate a fingerprint for this decision to use later.
         """
-        matches = []
-        for fingerprint, decision in self.items():
-            if (
-                source == decision.source
-                and target == decision.target
-                and contains(folder, decision.folder)
-            ):
-                matches.append((fingerprint, decision))
-        if matches:
-            for fingerprint, match in reversed(
-                sorted(matches, key=lambda m: len(m[1].folder))
-            ):
-                if match.response.is_allow():
+        found: Optional[Tuple[Decision, str]] = None
+        trie = self._by_pair.get((source, target))
+        if trie is not None:
+            for fingerprint, decision in trie.containing(_norm(folder)):
+                found = (decision, fingerprint)
+                if decision.response.is_allow():
                     break
-            return match, fingerprint
+        if found:
+            return found
         fingerprint = fingerprint_decision(source, target, folder)
         return None, fingerprint
 
@@ -284,7 +705,9 @@ class DecisionMatrix(Dict[str, Decision]):
         This method mutates the internal state and updates the policy on disk."""
         fingerprint = self.add_decision(source, target, folder, response)
         ConnectToFolderPolicy.apply_policy_changes_from(self)
-        self.save()
+        self._append_delta(
+            {"op": "set", "fp": fingerprint, "decision": self[fingerprint]}
+        )
         return fingerprint
 
     def lookup_decision_folder(
@@ -298,8 +721,10 @@ class DecisionMatrix(Dict[str, Decision]):
 
         This method mutates the internal state and updates the policy on disk."""
         match = self.get(fingerprint)
-        self.revoke_onetime_accesses_for_fingerprint(fingerprint)
-        if match and contains(requested_folder, match.folder):
+        if match is not None and match.response.is_onetime():
+            # The one-time grant is used up by this very request.
+            self._expire(fingerprint)
+        if match and _contains_norm(_norm(requested_folder), match.folder_with_sep):
             logger.info(
                 "Requested folder %s is contained in folder %s", requested_folder, match
             )
@@ -309,20 +734,67 @@ class DecisionMatrix(Dict[str, Decision]):
             return None
 
 
+def _policy_files(fntpl: str) -> Set[str]:
+    """Return the paths of the existing policy files matching a template."""
+    folder, prefix = os.path.split(fntpl % "")
+    try:
+        with os.scandir(folder) as entries:
+            return {
+                e.path
+                for e in entries
+                if e.name.startswith(prefix) and e.is_file(follow_symlinks=False)
+            }
+    except FileNotFoundError:
+        return set()
+
+
 class _LegacyConnectToFolderPolicy(object):
     FOLDER = "/etc/qubes-rpc/policy"
     FNTPL = os.path.join(FOLDER, CONNECT_RPCNAME + "+%s")
 
+    # The (fingerprint, allowed) pairs last written out by this process,
+    # and the identity of the policy files right after they were written.
+    _last_applied_state: Optional[Tuple[FrozenSet[Tuple[str, bool]], _FileKey]] = None
+
+    @staticmethod
+    def _policy_state(matrix: DecisionMatrix) -> FrozenSet[Tuple[str, bool]]:
+        return frozenset((fp, d.response.is_allow()) for fp, d in matrix.items())
+
+    def _target_key(self) -> _FileKey:
+        """Identify the current state of the policy files.
+
+        Policy files are only ever created, renamed or removed here, each of
+        which updates the directory holding them."""
+        return _file_key(os.path.dirname(self.FNTPL % ""))
+
+    def _is_applied(self, policy_state: FrozenSet[Tuple[str, bool]]) -> bool:
+        return self._last_applied_state == (policy_state, self._target_key())
+
+    def _applied(self, policy_state: FrozenSet[Tuple[str, bool]]) -> None:
+        key = self._target_key()
+        # Like git's racy index entries: another process may still modify
+        # the policy files within the same timestamp tick without changing
+        # the key, so only trust keys that are safely in the past.
+        if key is not None and time.time_ns() - key[0] > 2 * 10**9:
+            self._last_applied_state = (policy_state, key)
+        else:
+            self._last_applied_state = None
+
     def _ctf_policy(self, fingerprint: str) -> str:
         return self.FNTPL % fingerprint
 
     def grant_for(self, source: str, target: str, fingerprint: str) -> None:
         fn = self._ctf_policy(fingerprint)
-        if os.path.isfile(fn):
-            return
+        policy = "%s %s allow" % (source, target)
+        try:
+            with open(fn) as f:
+                if f.read() == policy:
+                    return
+        except FileNotFoundError:
+            pass
         logger.info("Creating %s", fn)
         with open(fn + ".tmp", "w") as f:
-            f.write("%s %s allow" % (source, target))
+            f.write(policy)
         os.chmod(fn + ".tmp", 0o664)
         os.rename(fn + ".tmp", fn)
 
@@ -337,15 +809,18 @@ class _LegacyConnectToFolderPolicy(object):
             pass
 
     def apply_policy_changes_from(self, matrix: DecisionMatrix) -> None:
-        existing_policy_files = glob.glob(self.FNTPL % "*")
+        state = self._policy_state(matrix)
+        if self._is_applied(state):
+            return
+        existing_policy_files = _policy_files(self.FNTPL)
         for fingerprint, decision in matrix.items():
-            if self.FNTPL % fingerprint in existing_policy_files:
-                existing_policy_files.remove(self.FNTPL % fingerprint)
+            existing_policy_files.discard(self._ctf_policy(fingerprint))
             action = self.grant_for if decision.response.is_allow() else self.revoke_for
             action(decision.source, decision.target, fingerprint)
         for p in existing_policy_files:
             logger.info("Removing %s", p)
             os.unlink(p)
+        self._applied(state)
 
 
 class _NewConnectToFolderPolicy(_LegacyConnectToFolderPolicy):
@@ -353,7 +828,7 @@ class _NewConnectToFolderPolicy(_LegacyConnectToFolderPolicy):
     FNTPL = os.path.join(FOLDER, "79-qubes-shared-folders.policy")
 
     def __init__(self) -> None:
-        old_policy_files = glob.glob(super().FNTPL % "*")
+        old_policy_files = _policy_files(super().FNTPL)
         old_lines = []
         for file in old_policy_files:
             fingerprint = file.partition("+")[2]
@@ -378,6 +853,9 @@ class _NewConnectToFolderPolicy(_LegacyConnectToFolderPolicy):
             for file in old_policy_files:
                 os.unlink(file)
 
+    def _target_key(self) -> _FileKey:
+        return _file_key(self.FNTPL)
+
     def known_fingerprints(self) -> List[str]:
         with open(self.FNTPL) as f:
             text = f.read()
@@ -429,6 +907,9 @@ class _NewConnectToFolderPolicy(_LegacyConnectToFolderPolicy):
 
         Unknown shares are removed and default to deny.
         """
+        state = self._policy_state(matrix)
+        if self._is_applied(state):
+            return
         existing_fingerprints = self.known_fingerprints()
         acted_upon = collections.defaultdict(bool)
         for fingerprint, decision in matrix.items():
@@ -438,6 +919,7 @@ class _NewConnectToFolderPolicy(_LegacyConnectToFolderPolicy):
         for fingerprint in existing_fingerprints:
             if not acted_upon[fingerprint]:
                 self.revoke_for("ignored", "ignored", fingerprint)
+        self._applied(state)
 
 
 ConnectToFolderPolicy = (
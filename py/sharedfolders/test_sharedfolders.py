@@ -4,7 +4,10 @@ import json
 import os
 import sys
 import tempfile
+import threading
+import time
 import unittest
+from typing import List, Optional, Type
 
 import sharedfolders
 
@@ -99,16 +102,331 @@ class TestDecisions(unittest.TestCase):
         assert decision is None, decision
         assert fingerprint == "a9b00af7d077959658b57b755fc32c1d", fingerprint
 
+    def test_lookup_after_delete(self) -> None:
+        global matrix
+        m = matrix.copy()
+        m.pop("fprint3")
+        decision, fingerprint = m.lookup_decision("one", "two", "/var/lib")
+        assert (
+            decision is not None
+            and decision.response is sharedfolders.RESPONSES.DENY_ALWAYS
+        ), decision
+        assert fingerprint == "fprint4"
+        m.pop("fprint4")
+        decision, fingerprint = m.lookup_decision("one", "two", "/var/lib")
+        assert decision is None, decision
+        m.pop("fprint")
+        m.pop("fprint2")
+        assert not m._by_pair, m._by_pair
+
+    def test_lookup_matches_sorted_scan(self) -> None:
+        def reference(
+            m: sharedfolders.DecisionMatrix, source: str, target: str, folder: str
+        ) -> Optional[str]:
+            matches = [
+                (f, d)
+                for f, d in m.items()
+                if d.source == source
+                and d.target == target
+                and sharedfolders.contains(folder, d.folder)
+            ]
+            if not matches:
+                return None
+            for f, d in reversed(sorted(matches, key=lambda m: len(m[1].folder))):
+                if d.response.is_allow():
+                    break
+            return f
+
+        m = matrix.copy()
+        for n, (folder, response) in enumerate(
+            [
+                ("/usr", sharedfolders.RESPONSES.DENY_ALWAYS),
+                ("/srv", sharedfolders.RESPONSES.DENY_ALWAYS),
+                ("/usr/lib", sharedfolders.RESPONSES.ALLOW_ONETIME),
+                ("/srv/www", sharedfolders.RESPONSES.DENY_ONETIME),
+                ("/", sharedfolders.RESPONSES.DENY_ALWAYS),
+                ("/home/user/x", sharedfolders.RESPONSES.DENY_ALWAYS),
+            ]
+        ):
+            m.put("extra%d" % n, sharedfolders.Decision("one", "two", folder, response))
+        for folder in [
+            "/",
+            "/usr",
+            "/usr/lib/x",
+            "/srv/www/y",
+            "/home",
+            "/home/user",
+            "/home/user/x/y",
+            "/var/lib",
+            "/opt",
+        ]:
+            decision, fingerprint = m.lookup_decision("one", "two", folder)
+            expected = reference(m, "one", "two", folder)
+            if expected is None:
+                assert decision is None, (folder, decision)
+            else:
+                assert fingerprint == expected, (folder, fingerprint, expected)
+
+
+class TestContains(unittest.TestCase):
+    def test_normalization(self) -> None:
+        for path in [
+            "/",
+            "/home",
+            "/home/",
+            "/home/user/.config",
+            "/home/./user",
+            "/home/../var",
+            "//home",
+            "/home//user/",
+            "/home/user/..",
+        ]:
+            expected = os.path.abspath(path).rstrip("/") + "/"
+            assert sharedfolders._norm(path) == expected, (path, expected)
+
+    def test_contains(self) -> None:
+        assert sharedfolders.contains("/home/user", "/home")
+        assert sharedfolders.contains("/home/", "/home")
+        assert sharedfolders.contains("/home/user/../other", "/home")
+        assert not sharedfolders.contains("/homer", "/home")
+        assert not sharedfolders.contains("/home/../var", "/home")
+
+
+class TestResponse(unittest.TestCase):
+    def test_from_string(self) -> None:
+        for r in [
+            sharedfolders.RESPONSES.ALLOW_ONETIME,
+            sharedfolders.RESPONSES.DENY_ONETIME,
+            sharedfolders.RESPONSES.ALLOW_ALWAYS,
+            sharedfolders.RESPONSES.DENY_ALWAYS,
+            sharedfolders.RESPONSES.BLOCK,
+        ]:
+            assert sharedfolders.Response.from_string(str(r)) is r, r
+        for s in ["invalid", "__module__", ""]:
+            self.assertRaises(ValueError, sharedfolders.Response.from_string, s)
+
+    def test_predicates(self) -> None:
+        R = sharedfolders.RESPONSES
+        for r, allow, onetime, block in [
+            (R.ALLOW_ONETIME, True, True, False),
+            (R.DENY_ONETIME, False, True, False),
+            (R.ALLOW_ALWAYS, True, False, False),
+            (R.DENY_ALWAYS, False, False, False),
+            (R.BLOCK, False, False, True),
+        ]:
+            assert r.is_allow() is allow, r
+            assert r.is_onetime() is onetime, r
+            assert r.is_block() is block, r
+
 
 class TestDecisionMatrixLoad(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        d = self.tmpdir.name
+
+        class klass(sharedfolders.DecisionMatrix):
+            POLICY_DB = os.path.join(d, "policy.db")
+
+        self.klass: Type[sharedfolders.DecisionMatrix] = klass
+
+    def tearDown(self) -> None:
+        sharedfolders._cache = None
+        self.tmpdir.cleanup()
+
+    def load_from_disk(self) -> sharedfolders.DecisionMatrix:
+        """Load the database as a process that has nothing cached would."""
+        sharedfolders._cache = None
+        return self.klass.load()
+
     def test_loads(self) -> None:
         global matrix
-        old = matrix.POLICY_DB
-        try:
-            with tempfile.NamedTemporaryFile() as t:
-                matrix.__class__.POLICY_DB = t.name
-                matrix.POLICY_DB = t.name
-                matrix.save()
-                matrix.load()
-        finally:
-            matrix.POLICY_DB = old
+        self.klass(matrix).save()
+        assert sorted(self.load_from_disk()) == sorted(matrix)
+
+    def test_load_sees_external_changes(self) -> None:
+        global matrix
+        klass = self.klass
+        m = klass(matrix)
+        m.save()
+        loaded = klass.load()
+        assert sorted(loaded) == sorted(matrix), loaded
+        loaded.pop("fprint")
+        assert "fprint" in klass.load()
+        with open(klass.POLICY_DB + ".new", "w") as f:
+            json.dump({}, f)
+        os.rename(klass.POLICY_DB + ".new", klass.POLICY_DB)
+        assert len(klass.load()) == 0
+
+    def test_load_without_directory(self) -> None:
+        self.klass.POLICY_DB = os.path.join(self.tmpdir.name, "missing", "policy.db")
+        assert len(self.klass.load()) == 0
+
+    def test_cached_loads_are_independent(self) -> None:
+        global matrix
+        klass = self.klass
+        klass(matrix).save()
+        a, b = klass.load(), klass.load()
+        assert type(a) is klass
+        a.pop("fprint3")
+        decision, fingerprint = b.lookup_decision("one", "two", "/var/lib")
+        assert fingerprint == "fprint3", fingerprint
+        assert "fprint3" in klass.load()
+        decision, fingerprint = a.lookup_decision("one", "two", "/var/lib")
+        assert fingerprint == "fprint4", fingerprint
+
+    def test_unchanged_save_keeps_file(self) -> None:
+        global matrix
+        klass = self.klass
+        klass(matrix).save()
+        inode = os.stat(klass.POLICY_DB).st_ino
+        klass(matrix).save()
+        assert os.stat(klass.POLICY_DB).st_ino == inode
+        m = klass(matrix)
+        m.pop("fprint")
+        m.save()
+        assert os.stat(klass.POLICY_DB).st_ino != inode
+        assert "fprint" not in klass.load()
+
+    def test_delta_log(self) -> None:
+        global matrix
+        klass = self.klass
+        klass.COMPACT_AFTER = 3
+        klass(matrix).save()
+        m = klass.load()
+        m.pop("fprint")
+        m._append_delta({"op": "del", "fp": "fprint"})
+        m.put(
+            "new",
+            sharedfolders.Decision(
+                "one", "two", "/srv", sharedfolders.RESPONSES.ALLOW_ONETIME
+            ),
+        )
+        m._append_delta({"op": "set", "fp": "new", "decision": m["new"]})
+        loaded = self.load_from_disk()
+        assert sorted(loaded) == ["fprint2", "fprint3", "fprint4", "new"], loaded
+        assert loaded["new"].response is sharedfolders.RESPONSES.ALLOW_ONETIME
+        decision, fingerprint = loaded.lookup_decision("one", "two", "/home/user")
+        assert fingerprint == "fprint2", fingerprint
+        assert os.path.exists(klass.POLICY_DB + ".delta")
+        loaded._append_delta({"op": "del", "fp": "new"})
+        compacted = self.load_from_disk()
+        assert "new" not in compacted
+        assert not os.path.exists(klass.POLICY_DB + ".delta")
+        assert sorted(self.load_from_disk()) == ["fprint2", "fprint3", "fprint4"]
+
+    def test_compaction_keeps_concurrent_changes(self) -> None:
+        global matrix
+        klass = self.klass
+        klass.COMPACT_AFTER = 2
+        klass(matrix).save()
+        m = klass.load()
+        for fp in ["fprint", "fprint2"]:
+            m.pop(fp)
+            m._append_delta({"op": "del", "fp": fp})
+        other = klass()
+        other.put(
+            "new",
+            sharedfolders.Decision(
+                "one", "two", "/srv", sharedfolders.RESPONSES.ALLOW_ONETIME
+            ),
+        )
+        threads: List[threading.Thread] = []
+        replay = klass._replay_deltas
+
+        def replay_then_append(
+            self: sharedfolders.DecisionMatrix, db: sharedfolders._FileKey
+        ) -> int:
+            n = replay(self, db)
+            if not threads:
+                t = threading.Thread(
+                    target=other._append_delta,
+                    args=({"op": "set", "fp": "new", "decision": other["new"]},),
+                )
+                threads.append(t)
+                t.start()
+                time.sleep(0.2)
+            return n
+
+        klass._replay_deltas = replay_then_append  # type: ignore
+        self.load_from_disk()
+        threads[0].join()
+        del klass._replay_deltas
+        assert sorted(self.load_from_disk()) == ["fprint3", "fprint4", "new"]
+
+    def test_interleaved_appends_do_not_cache_stale_matrix(self) -> None:
+        global matrix
+        klass = self.klass
+        klass(matrix).save()
+        a, b = klass.load(), klass.load()
+        b.pop("fprint")
+        b._append_delta({"op": "del", "fp": "fprint"})
+        # a was loaded before b's change, so its view must not be cached.
+        a.pop("fprint2")
+        a._append_delta({"op": "del", "fp": "fprint2"})
+        assert sorted(klass.load()) == ["fprint3", "fprint4"]
+
+    def test_stale_delta_is_not_replayed(self) -> None:
+        global matrix
+        klass = self.klass
+        klass(matrix).save()
+        m = klass.load()
+        m.put(
+            "new",
+            sharedfolders.Decision(
+                "one", "two", "/srv", sharedfolders.RESPONSES.ALLOW_ALWAYS
+            ),
+        )
+        m._append_delta({"op": "set", "fp": "new", "decision": m["new"]})
+        with open(klass.POLICY_DB + ".delta", "rb") as f:
+            delta = f.read()
+        m.pop("new")
+        m.save()
+        # Pretend that removing the delta file was lost in a crash.
+        with open(klass.POLICY_DB + ".delta", "wb") as g:
+            g.write(delta)
+        loaded = self.load_from_disk()
+        assert "new" not in loaded, loaded
+        # The database itself stays a plain map of fingerprints.
+        with open(klass.POLICY_DB) as f:
+            assert sorted(json.load(f)) == sorted(matrix)
+        loaded.pop("fprint")
+        loaded._append_delta({"op": "del", "fp": "fprint"})
+        assert sorted(self.load_from_disk()) == ["fprint2", "fprint3", "fprint4"]
+
+
+class TestLegacyConnectToFolderPolicy(unittest.TestCase):
+    def test_apply_policy_changes(self) -> None:
+        global matrix
+        with tempfile.TemporaryDirectory() as d:
+
+            class policy(sharedfolders._LegacyConnectToFolderPolicy):
+                FNTPL = os.path.join(d, sharedfolders.CONNECT_RPCNAME + "+%s")
+
+            p = policy()
+            stale = p.FNTPL % "stale"
+            with open(stale, "w") as f:
+                f.write("one two allow")
+            p.apply_policy_changes_from(matrix)
+            assert sorted(os.listdir(d)) == [
+                sharedfolders.CONNECT_RPCNAME + "+fprint",
+                sharedfolders.CONNECT_RPCNAME + "+fprint3",
+            ], os.listdir(d)
+            # Changes made by someone else are reconciled even when the
+            # matrix itself is unchanged.
+            os.unlink(p.FNTPL % "fprint")
+            p.apply_policy_changes_from(matrix.copy())
+            assert os.path.exists(p.FNTPL % "fprint")
+            # With the policy files untouched since the last apply, applying
+            # an unchanged matrix again does not look at them.
+            past = os.stat(d).st_mtime_ns - 10 * 10**9
+            os.utime(d, ns=(past, past))
+            p.apply_policy_changes_from(matrix)
+            calls = []
+            p.grant_for = lambda *args: calls.append(args)  # type: ignore
+            p.apply_policy_changes_from(matrix.copy())
+            assert not calls, calls
+            del p.grant_for
+            m = matrix.copy()
+            m.pop("fprint3")
+            p.apply_policy_changes_from(m)
+            assert os.listdir(d) == [sharedfolders.CONNECT_RPCNAME + "+fprint"]
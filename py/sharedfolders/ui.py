@@ -320,7 +320,7 @@ class FolderShareManager(Gtk.Window):  # type: ignore
         for f, decision in list(self.working_decision_matrix.items()):
             if decision.response.is_onetime():
                 continue
-            del self.working_decision_matrix[f]
+            self.working_decision_matrix.pop(f)
         for obj, response in [
             (self.allowed_shares_list, RESPONSES.ALLOW_ALWAYS),
             (self.denied_shares_list, RESPONSES.DENY_ALWAYS),
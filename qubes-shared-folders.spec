@@ -16,6 +16,7 @@ BuildRequires:  python3
 BuildRequires:  python3-pytest
 BuildRequires:  python3-mock
 BuildRequires:  python3-mypy
+BuildRequires:  python3-orjson
 BuildRequires:  desktop-file-utils
 BuildRequires:  cargo-rpm-macros >= 24
 BuildRequires:  python3-rpm-macros
@@ -30,6 +31,7 @@ Requires:       qubes-core-dom0-linux >= 4.1
 Requires:       python3
 Requires:       gobject-introspection
 Requires:       gtk3
+Recommends:     python3-orjson
 BuildArch:      noarch
 
 %description
@@ -56,6 +58,8 @@ for target in install-client install-server install-dom0; do
     make $target DESTDIR="$RPM_BUILD_ROOT" BINDIR=%{_bindir} SYSCONFDIR=%{_sysconfdir} LIBEXECDIR=%{_libexecdir} DATADIR=%{_datadir} || exit $?
 done
 touch "$RPM_BUILD_ROOT"/%{_sysconfdir}/qubes/shared-folders/policy.db
+touch "$RPM_BUILD_ROOT"/%{_sysconfdir}/qubes/shared-folders/policy.db.delta
+touch "$RPM_BUILD_ROOT"/%{_sysconfdir}/qubes/shared-folders/policy.db.lock
 
 %check
 desktop-file-validate desktop/*.desktop
@@ -74,6 +78,8 @@ make test || exit $?
 %config(noreplace) %attr(0664, root, qubes) %{_sysconfdir}/qubes/policy.d/*-qubes-shared-folders.policy
 %dir %attr(2775, root, qubes) %{_sysconfdir}/qubes/shared-folders
 %ghost %config(noreplace) %attr(0664, root, qubes) %{_sysconfdir}/qubes/shared-folders/policy.db
+%ghost %attr(0664, root, qubes) %{_sysconfdir}/qubes/shared-folders/policy.db.delta
+%ghost %attr(0664, root, qubes) %{_sysconfdir}/qubes/shared-folders/policy.db.lock
 %attr(0755, root, root) %{_sysconfdir}/qubes-rpc/ruddo.AuthorizeFolderAccess
 %attr(0755, root, root) %{_sysconfdir}/qubes-rpc/ruddo.QueryFolderAuthorization
 %attr(0755, root, root) %{_libexecdir}/qvm-authorize-folder-access